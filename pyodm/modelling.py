@@ -2,9 +2,34 @@
 """
 
 import datetime
+import functools
 import numpy as np
 import pandas as pd
 
+from scipy.interpolate import PPoly
+
+@functools.lru_cache(maxsize=256)
+def _parse_ymd(date):
+    """Parse a string of the form YYYY-MM-DD into a datetime.date"""
+    year, month, day = date.split("-")
+    return datetime.date(int(year), int(month), int(day))
+
+def _day_number(date):
+    """Return the number of days since the Unix epoch for a date or array of dates, as a float"""
+    return np.asarray(date, dtype="datetime64[D]").astype(np.float64)
+
+def _evaluate_ppoly(breaks, coefs, x):
+    """Evaluate a piecewise polynomial (highest order coefficients first) using Horner's method"""
+    # Find the interval containing each point, extrapolating beyond the ends
+    idx = np.clip(np.searchsorted(breaks, x, side="right") - 1, 0, coefs.shape[1] - 1)
+    dx = x - breaks[idx]
+
+    # Horner's method
+    values = coefs[0, idx]
+    for c in coefs[1:]:
+        values = values*dx + c[idx]
+    return values
+
 class AggregateModel():
     """Class representing an aggregate model for multipe sampling sites.
 
@@ -24,6 +49,27 @@ class AggregateModel():
         """Class initialization"""
         self._data = data
         self._weights = weights
+        self._build_weight_array()
+
+        # Piecewise polynomial spline models keyed by (site, gene_1, gene_2, units)
+        self._spline_cache = {}
+
+        # Day numbers of the first and last sample dates keyed by site
+        self._date_bounds = {}
+
+        # Daily evaluation grids keyed by (start_date, end_date)
+        self._grid_cache = {}
+
+    def refresh(self):
+        """Discard all cached spline models, date ranges and date grids.
+
+        This must be called if the site data or weights are modified after
+        the model has been created.
+        """
+        self._build_weight_array()
+        self._spline_cache.clear()
+        self._date_bounds.clear()
+        self._grid_cache.clear()
 
     def str_to_datetime(self, date):
         """Convert a string of the form YYYY-MM-DD to a datetime object.
@@ -38,7 +84,7 @@ class AggregateModel():
         datetime.date
             Date as a datetime.date object.
         """
-        return datetime.datetime.strptime(date, "%Y-%m-%d").date()
+        return _parse_ymd(date)
 
     def get_date_list(self, start_date, end_date):
         """Get a list of dates (spaced daily) based on start and end dates.
@@ -54,17 +100,61 @@ class AggregateModel():
 
         Returns
         -------
-        list of datetime.date
-            A list of dates, evenly spaced at 1-day intervals.
+        numpy.ndarray of numpy.datetime64
+            An array of dates, evenly spaced at 1-day intervals.
         """
         start_date = self.str_to_datetime(start_date)
         end_date = self.str_to_datetime(end_date)
 
-        dates = [start_date]
-        while dates[-1] <= end_date:
-            dates.append(dates[-1] + datetime.timedelta(days=1))
+        return pd.date_range(start=start_date, end=end_date, freq="D").values
+
+    def _build_weight_array(self):
+        """Store the weights as an array, along with the index of each site in the array"""
+        self._site_order = list(self._weights)
+        self._site_idx = {site: i for i, site in enumerate(self._site_order)}
+        self._weights_arr = np.fromiter(self._weights.values(), dtype=np.float64, count=len(self._weights))
+
+    def _get_eval_grid(self, start_date, end_date):
+        """Return the (cached) daily dates and their float day numbers, shared by all sites"""
+        key = (start_date, end_date)
+        if key not in self._grid_cache:
+            dates = self.get_date_list(start_date, end_date)
+            ticks = _day_number(dates)
+            dates.flags.writeable = False
+            ticks.flags.writeable = False
+            self._grid_cache[key] = (dates, ticks)
+        return self._grid_cache[key]
+
+    def _get_date_bounds(self, site):
+        """Return the (cached) day numbers of the first and last sample dates for a site"""
+        if site not in self._date_bounds:
+            site_data = self._data[site]
+            self._date_bounds[site] = (_day_number(site_data.first_sample_date), _day_number(site_data.last_sample_date))
+        return self._date_bounds[site]
+
+    def _get_spline_poly(self, site, gene_1, gene_2, units):
+        """Return the (cached) start day number and piecewise polynomial form of a site's spline model"""
+        key = (site, gene_1, gene_2, units)
+        if key not in self._spline_cache:
+            start_date, tck = self._data[site].get_spline_fit(gene_1, gene_2, units)
+            self._spline_cache[key] = (_day_number(start_date), PPoly.from_spline(tck))
+        return self._spline_cache[key]
+
+    def _eval_site(self, site, gene_1, gene_2, ticks, units):
+        """Return the spline values for a site at the given day numbers, with NaN outside the range of the data"""
+        # Get the model for all dates requested even if out of range
+        start, poly = self._get_spline_poly(site, gene_1, gene_2, units)
+        values = _evaluate_ppoly(poly.x, poly.c, ticks - start)
+
+        # Fill dates outside the range of the actual data with NaN
+        min_date, max_date = self._get_date_bounds(site)
+        values[(ticks < min_date) | (ticks > max_date)] = np.nan
+
+        return values
 
-        return dates
+    def _eval_sites(self, sites, gene_1, gene_2, ticks, units):
+        """Return a list with the spline values for each site at the given day numbers"""
+        return [self._eval_site(site, gene_1, gene_2, ticks, units) for site in sites]
 
     def get_site_spline(self, site, gene_1, gene_2, start_date, end_date, units="gcL"):
         """Get a spline curve for a given site.
@@ -94,24 +184,8 @@ class AggregateModel():
             labelled "sampleDate" and the values are in the column labelled
             "value".
         """
-        # Get the model for all dates requested even if out of range
-        model = self._data[site].get_spline_model(gene_1, gene_2, units)
-        dates = self.get_date_list(start_date, end_date)
-        values = [float(model(date)) for date in dates]
-
-        # Get the date limits for the actual data
-        min_date = self._data[site].sample_data["sampleDate"].min()
-        max_date = self._data[site].sample_data["sampleDate"].max()
-
-        # Fill out of range dates with None
-        for i, date in enumerate(dates):
-            if date < min_date:
-                values[i] = None
-            if date > max_date:
-                values[i] = None
-
-        # Return the data
-        return pd.DataFrame({"sampleDate" : dates, "value": values})
+        dates, ticks = self._get_eval_grid(start_date, end_date)
+        return pd.DataFrame({"sampleDate" : dates, "value": self._eval_site(site, gene_1, gene_2, ticks, units)})
 
     def get_multisite_splines(self, sites, gene_1, gene_2, start_date, end_date, units="gcL"):
         """Get spline curves for multiple sites.
@@ -141,13 +215,12 @@ class AggregateModel():
             labelled "sampleDate" and the values are in the columns labelled
             "value_X", where X represents the site name.
         """
-        splines = self.get_site_spline(sites[0], gene_1, gene_2, start_date, end_date, units)
-        splines = splines.rename(columns={"value" : "value_{}".format(sites[0])})
-        for site in sites[1:]:
-            spline = self.get_site_spline(site, gene_1, gene_2, start_date, end_date, units)
-            splines = splines.merge(spline, how="left", on="sampleDate")
-            splines = splines.rename(columns={"value" : "value_{}".format(site)})
-        return splines
+        # All of the site splines share the same dates, so the columns can be
+        # assembled directly rather than merged one site at a time
+        dates, ticks = self._get_eval_grid(start_date, end_date)
+        site_values = self._eval_sites(sites, gene_1, gene_2, ticks, units)
+        values = {"value_{}".format(site): value for site, value in zip(sites, site_values)}
+        return pd.DataFrame({"sampleDate" : dates, **values})
 
     def get_aggregate_model(self, sites, gene_1, gene_2, start_date, end_date, units="gcL"):
         """Get a weighted aggregate model for multiple sites.
@@ -176,28 +249,25 @@ class AggregateModel():
             ratio of the sum of weighting factors for the represented data
             to the total weighting for all sites is in the column "ratio".
         """
-        # Get the spline models for each site
-        splines = self.get_multisite_splines(sites, gene_1, gene_2, start_date, end_date, units)
-
-        # Store the names of the columns for the site spline models and weights
-        spline_columns = []
-        weight_columns = []
-
-        for site in sites:
-            # Add to column names for this site
-            spline_columns.append("value_{}".format(site))
-            weight_columns.append("weight_{}".format(site))
-            # Multiply model data by weighting factor
-            splines[spline_columns[-1]] = splines[spline_columns[-1]]*self._weights[site]
-            # Set the weights, where the weight is zero if the value is NaN
-            splines[weight_columns[-1]] = self._weights[site]
-            splines.loc[splines[spline_columns[-1]].isna(), weight_columns[-1]] = 0.0
+        # Get the spline models for each site and their weights
+        dates, ticks = self._get_eval_grid(start_date, end_date)
+        site_values = self._eval_sites(sites, gene_1, gene_2, ticks, units)
+        weights = self._weights_arr[[self._site_idx[site] for site in sites]]
+
+        # Accumulate the weighted values and the sum of the weights for the
+        # sites with valid data on each date
+        weighted_sum = np.zeros(len(ticks))
+        valid_weight = np.zeros(len(ticks))
+        for values, weight in zip(site_values, weights):
+            valid = ~np.isnan(values)
+            weighted_sum += weight*np.where(valid, values, 0.0)
+            valid_weight += weight*valid
 
         # Divide by sum of weights
-        splines["value"] = splines[spline_columns].sum(axis=1)/splines[weight_columns].sum(axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            value = weighted_sum/valid_weight
 
         # Caclulate ratio of weights of valid data to total weight
-        weight_sum = sum(self._weights[site] for site in sites)
-        splines["ratio"] = splines[weight_columns].sum(axis=1)/weight_sum
+        ratio = valid_weight/weights.sum()
 
-        return splines[["sampleDate", "value", "ratio"]]
+        return pd.DataFrame({"sampleDate" : dates, "value" : value, "ratio" : ratio})
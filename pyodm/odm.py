@@ -5,13 +5,20 @@ an open data model that is commonly used for wastewater-based surveillance.
 The data model is described here: https://github.com/Big-Life-Lab/PHES-ODM.
 """
 
+import numpy as np
 import pandas as pd
 from datetime import datetime
+import csv
+import functools
+import io
+import os
 import warnings
+import yaml
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from odm_validation.validation import validate_data
 import odm_validation.utils as utils
-import tempfile
+from .sitedata import SiteData
 
 
 class OdmTables():
@@ -57,14 +64,94 @@ class CSVs(OdmTables):
 excel_extensions = ['.xls', '.xlsx', '.xlsm', '.xlsb', '.odf', '.ods', '.odt']
 default_schema_file = Path(__file__).parent / Path('assets/schema-v1.1.0.yml')
 
+# Use the (much faster) calamine Excel reader if it is available; pandas supports it from version 2.2
+try:
+    import python_calamine  # noqa: F401
+    excel_engine = 'calamine' if tuple(int(v) for v in pd.__version__.split('.')[:2]) >= (2, 2) else None
+except ImportError:
+    excel_engine = None
 
-def _validate_csvs(data_loc, validation_schema_file):
+# Likewise, use the (faster) xlsxwriter Excel writer for .xlsx files if it is available
+try:
+    import xlsxwriter  # noqa: F401
+    xlsx_writer_engine = 'xlsxwriter'
+except ImportError:
+    xlsx_writer_engine = None
 
-    schema = utils.import_schema(validation_schema_file)
+# ID and measure type/unit columns that are stored as categoricals, since they repeat across many rows
+categorical_columns = {
+    'sample': ['siteID', 'reporterID'],
+    'ww_measure': ['sampleID', 'type', 'unit', 'reporterID', 'labID', 'assayMethodID'],
+    'site_measure': ['sampleID', 'siteID', 'type', 'unit', 'reporterID'],
+}
+
+
+def _schema_key(schema_file):
+    """Return the resolved path and modification time of a schema file, for use as a cache key."""
+    schema_file = Path(schema_file).resolve()
+    return str(schema_file), schema_file.stat().st_mtime_ns
+
+
+@functools.lru_cache(maxsize=8)
+def _load_schema(schema_file, mtime):
+    """Load a validation schema, with the result cached by path and modification time."""
+    return utils.import_schema(Path(schema_file))
+
+
+@functools.lru_cache(maxsize=8)
+def _csv_dtypes(schema_file, mtime):
+    """Return the dtypes of the text columns of each table, as declared in the schema file.
+
+    The ID columns are used as keys to join the tables, so any column declared as a string ID in one
+    table is read as a string in every table, to keep the keys of the same type across tables.
+    """
+    with open(schema_file) as f:
+        schema = yaml.safe_load(f)['schema']
+
+    dtypes = {}
+    for attr in OdmTables.attributes():
+        fields = schema.get(Path(getattr(CSVs, attr)).stem, {}).get('schema', {}).get('schema', {})
+        dtypes[attr] = {name: str for name, field in fields.items()
+                        if isinstance(field, dict) and field.get('type') == 'string'}
+
+    id_columns = {name: str for table_dtypes in dtypes.values() for name in table_dtypes if name.endswith('ID')}
+    return {attr: {**id_columns, **table_dtypes} for attr, table_dtypes in dtypes.items()}
+
+
+def _dataset_records(df, chunk_size=10000):
+    """Yield the rows of a table as dicts of strings, in the same form as a CSV file read by the validator.
+
+    The table is converted in chunks of rows so that only one chunk at a time is held as CSV text.
+    """
+    for start in range(0, len(df), chunk_size):
+        yield from csv.DictReader(io.StringIO(df.iloc[start:start + chunk_size].to_csv(index=False)))
+
+
+def _categorize(attr, df):
+    """Convert the ID columns of a table listed in ``categorical_columns`` to categoricals."""
+    for column in categorical_columns.get(attr, []):
+        if column in df:
+            df[column] = df[column].astype('category')
+    return df
+
+
+def _in_index(column, index):
+    """Return a boolean mask of the values of a column that are found in an index."""
+    # For categoricals only the categories need to be looked up; the rows
+    # then take the result of their category (missing values have code -1)
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        found = np.append(index.get_indexer(column.cat.categories) >= 0, index.hasnans)
+        return found[column.cat.codes.to_numpy()]
+    return index.get_indexer(column) >= 0
+
+
+def _validate_tables(tables, validation_schema_file):
+
+    schema = _load_schema(*_schema_key(validation_schema_file))
     validation_summary = {}
 
     for attr in OdmTables.attributes():
-        samples = utils.import_dataset(data_loc / getattr(CSVs, attr))
+        samples = list(_dataset_records(tables[attr]))
         data = {"samples": samples}
         report = validate_data(schema, data)
         if len(report.errors) > 0:
@@ -80,6 +167,33 @@ def _validate_csvs(data_loc, validation_schema_file):
     return validation_summary
 
 
+class _LazyTables(dict):
+    """Dict of the ODM tables, in which the pending tables are only read when one of them is first accessed.
+
+    Parameters
+    ----------
+    read_tables : callable, optional
+        Function taking a list of table attributes and returning a dict of the
+        tables read for them.
+    pending : iterable of str, optional
+        Attributes of the tables that have not been read yet.
+    """
+
+    def __init__(self, read_tables=None, pending=()):
+        """Class initialization"""
+        super().__init__()
+        self._read_tables = read_tables
+        self._pending = set(pending)
+
+    def __missing__(self, attr):
+        """Read all of the pending tables (together, so that e.g. an Excel workbook is only parsed once)"""
+        if attr not in self._pending:
+            raise KeyError(attr)
+        self.update(self._read_tables(sorted(a for a in self._pending if a not in self)))
+        self._pending.clear()
+        return self[attr]
+
+
 class ODM():
     """Class used to represent an Open Data Model file as a set of pandas
     DataFrames.
@@ -96,31 +210,36 @@ class ODM():
     ``Sheet 6 - Sample`` or ``Sample.csv`` which has a column ``sampleDate`` added.
     The ``sampleDate`` field unifies the ``dateTime`` and ``dateTimeEnd`` which
     are used for grab and composite samples, respectively.
+
+    ID, measure type and unit columns that repeat across many rows of the
+    ``Sample``, ``WWMeasure`` and ``SiteMeasure`` tables (see
+    ``categorical_columns``) are stored with a categorical dtype.
+
+    If the data is not validated, the tables are only read from the file(s)
+    when one of them is first used.
     """
 
     def __init__(self, data_loc=None, validate_data=True, validation_schema_file=default_schema_file):
         """Class initialization"""
-        self._data = {}
+        self._data = _LazyTables()
         self.validation_summary = {}
 
-        csv_dir = data_loc
-
         if data_loc:
             data_loc = Path(data_loc)
             suffix = data_loc.suffix
 
             if suffix in excel_extensions:  # Excel file
-                for attr in OdmTables.attributes():
-                    self._data[attr] = self.read_sheet(data_loc, getattr(Sheets, attr))
-
-                if validate_data:  # Export excel to temporary csv files
-                    out_dir = Path(tempfile.mkdtemp(suffix='-' + data_loc.name))
-                    csv_dir = out_dir / 'csv-files'
-                    self.export_csvs(csv_dir)
+                read_tables = functools.partial(self._read_sheets, data_loc)
+                files = [data_loc]
 
             elif suffix == '':  # Directory
-                for attr in OdmTables.attributes():
-                    self._data[attr] = self.read_csv(data_loc / getattr(CSVs, attr))
+                # Declare the text columns from the schema if one is available, otherwise infer all of the types
+                if validation_schema_file and Path(validation_schema_file).is_file():
+                    dtypes = _csv_dtypes(*_schema_key(validation_schema_file))
+                else:
+                    dtypes = dict.fromkeys(OdmTables.attributes())
+                read_tables = functools.partial(self._read_csvs, data_loc, dtypes)
+                files = [data_loc / getattr(CSVs, attr) for attr in OdmTables.attributes()]
 
             else:
                 raise TypeError(f'A filepath with invalid extension {suffix}, was passed to the ODM constructor. \n'
@@ -128,27 +247,54 @@ class ODM():
                                 f' Excel-like file with one of the following extensions: {excel_extensions}')
 
             if validate_data:
-                self.validation_summary = _validate_csvs(csv_dir, validation_schema_file)
+                # All of the tables are needed for validation, so read them together
+                self._data.update(read_tables(OdmTables.attributes()))
+                self.validation_summary = _validate_tables(self._data, validation_schema_file)
+            else:
+                # Otherwise only read the tables when one of them is first used, but check that they exist now
+                missing_files = [str(file) for file in files if not file.exists()]
+                if missing_files:
+                    raise FileNotFoundError(f'The ODM data file(s) {missing_files} could not be found.')
+                self._data = _LazyTables(read_tables, OdmTables.attributes())
 
         else:
             for attr in OdmTables.attributes():
                 self._data[attr] = pd.DataFrame()
 
-    def read_csv(self, file_name):
+    def _read_sheets(self, file_name, attrs):
+        """Read the sheets of an Excel file for the given table attributes"""
+        # Read all of the sheets at once so the workbook is only opened and parsed once
+        sheets = self.read_sheet(file_name, [getattr(Sheets, attr) for attr in attrs])
+        return {attr: _categorize(attr, sheets[getattr(Sheets, attr)]) for attr in attrs}
+
+    def _read_csvs(self, dir_name, dtypes, attrs):
+        """Read the CSV files in a directory for the given table attributes"""
+        # The files are independent, so read them concurrently. The warnings filters are shared by all
+        # threads, so they are also saved and restored here, around all of the reads.
+        with warnings.catch_warnings(), ThreadPoolExecutor(max_workers=min(len(attrs), os.cpu_count() or 1)) as executor:
+            warnings.simplefilter(action='ignore', category=UserWarning)
+            tables = {attr: executor.submit(self.read_csv, dir_name / getattr(CSVs, attr), dtypes[attr]) for attr in attrs}
+        return {attr: _categorize(attr, table.result()) for attr, table in tables.items()}
+
+    def read_csv(self, file_name, dtype=None):
         """Read a csv file.
 
         Parameters
         ----------
         file_name : str, Path
             Name of the CSV file.
+        dtype : dict, optional
+            Data types of the columns, as accepted by ``pandas.read_csv``.
+            Columns that are not listed have their type inferred.
 
         Returns
         -------
         pandas.DataFrame
             The data contained in the specified CSV file.
         """
-        warnings.simplefilter(action='ignore', category=UserWarning)
-        return pd.read_csv(file_name)
+        with warnings.catch_warnings():
+            warnings.simplefilter(action='ignore', category=UserWarning)
+            return pd.read_csv(file_name, dtype=dtype)
 
     def read_sheet(self, file_name, sheet_name):
         """Read a sheet from an Excel file.
@@ -157,16 +303,19 @@ class ODM():
         ----------
         file_name : str, Path
             Name of the Excel file.
-        sheet_name : str
-            Name of the sheet to be read.
+        sheet_name : str or list of str
+            Name of the sheet to be read, or a list of names to read several
+            sheets from the file at once.
 
         Returns
         -------
-        pandas.DataFrame
-            The data contained in the specified Excel sheet.
+        pandas.DataFrame or dict of pandas.DataFrame
+            The data contained in the specified Excel sheet, or a dict of the
+            data keyed by sheet name if a list of sheets was given.
         """
-        warnings.simplefilter(action='ignore', category=UserWarning)
-        return pd.read_excel(file_name, sheet_name)
+        with warnings.catch_warnings():
+            warnings.simplefilter(action='ignore', category=UserWarning)
+            return pd.read_excel(file_name, sheet_name, engine=excel_engine)
 
     def export_csvs(self,dir_path):
         """Export ODM formatted dataset into directory as CSV files.
@@ -181,9 +330,11 @@ class ODM():
         if not dir_path.is_dir():
             dir_path.mkdir()
 
+        # Write through a larger buffer than the default to reduce the number of system calls
         for attr in CSVs.attributes():
             df = self._data[attr]
-            df.to_csv(dir_path / getattr(CSVs, attr), index=False)
+            with open(dir_path / getattr(CSVs, attr), 'wb', buffering=1 << 20) as f:
+                df.to_csv(f, index=False)
 
     def export_excel(self, file_name):
         """Export ODM formatted dataset into Excel sheets.
@@ -193,17 +344,20 @@ class ODM():
         file_name : str, Path
             Name of the Excel file.
         """
-        with pd.ExcelWriter(file_name) as excel_writer:
+        # Only choose the engine for file paths; for other targets (e.g. buffers) pandas picks it
+        is_path = isinstance(file_name, (str, os.PathLike))
+        engine = xlsx_writer_engine if is_path and Path(file_name).suffix == '.xlsx' else None
+        with pd.ExcelWriter(file_name, engine=engine) as excel_writer:
             for attr in Sheets.attributes():
                 df = self._data[attr]
-                df.set_index(df.columns[0], inplace=True)
-                df.to_excel(excel_writer, sheet_name=getattr(Sheets, attr))
+                df.to_excel(excel_writer, sheet_name=getattr(Sheets, attr), index=False)
 
     def filter_dates(self, start_date=None, end_date=None):
         """Filter the data by sample date.
 
         Data before start_date and after end_date will be deleted from all
-        DataFrames. Data falling exactly on these dates will be retained.
+        DataFrames. Data falling exactly on these dates will be retained. The
+        rows of the filtered DataFrames are renumbered from zero.
 
         Parameters
         ----------
@@ -212,33 +366,49 @@ class ODM():
         end_date : str, optional
             End date in the format "YYYY-MM-DD"
         """
-        # Get a dataframe with the sample IDs and the time information
-        samples = self.sample[['sampleID', 'dateTimeEnd', 'dateTime']].copy()
-
-        # Add a temporary column that takes the date from either dateTime or
-        # dateTimeEnd, whichever is present
-        samples['sampleDate'] = pd.to_datetime(samples['dateTimeEnd'].fillna(samples['dateTime'])).dt.date
-
-        # Add a temporary column that tracks whether to keep the sample
-        samples['keep'] = True
-
-        # Find samples that meet date criteria
-        if start_date:
-            start_date = datetime.strptime(start_date, "%Y-%m-%d").date()
-            samples['keep'] = (samples['keep'] & (samples['sampleDate'] >= start_date))
-        if end_date:
-            end_date = datetime.strptime(end_date, "%Y-%m-%d").date()
-            samples['keep'] = (samples['keep'] & (samples['sampleDate'] <= end_date))
-        samples = samples[samples['keep']]
-
-        # Filter the data that is date-based
-        self._data['sample'] = self.sample.loc[self.sample['sampleID'].isin(samples['sampleID'])]
-        self._data['ww_measure'] = self.ww_measure.loc[self.ww_measure['sampleID'].isin(samples['sampleID'])]
-        self._data['site_measure'] = self.site_measure.loc[self.site_measure['sampleID'].isin(samples['sampleID'])]
+        # Find samples that meet date criteria (all samples are kept if no
+        # criteria are given, including those without a date)
+        samples = self.sample['sampleID']
+        if start_date or end_date:
+            # Take the date from either dateTime or dateTimeEnd, whichever is present
+            sample_dates = pd.to_datetime(self.sample['dateTimeEnd'].fillna(self.sample['dateTime']))
+            sample_dates = sample_dates.values.astype('datetime64[D]')
+
+            keep = np.ones(len(sample_dates), dtype=bool)
+            if start_date:
+                keep &= sample_dates >= np.datetime64(datetime.strptime(start_date, "%Y-%m-%d").date())
+            if end_date:
+                keep &= sample_dates <= np.datetime64(datetime.strptime(end_date, "%Y-%m-%d").date())
+            samples = samples[keep]
+
+        # Filter the data that is date-based, using a single hash table of
+        # the kept sample IDs for all of the tables (the filtered tables are
+        # renumbered so that they keep a RangeIndex)
+        kept_ids = pd.Index(samples.unique())
+        for attr in ['sample', 'ww_measure', 'site_measure']:
+            df = self._data[attr]
+            self._data[attr] = df.loc[_in_index(df['sampleID'], kept_ids)].reset_index(drop=True)
 
         # Return the object to allow for assignment
         return self
 
+    def build_all_sites(self):
+        """Create the site data for every site.
+
+        Returns
+        -------
+        dict
+            The keys of the dict are the site IDs in the "Site" data and the
+            values are SiteData objects representing each site.
+        """
+        site_ids = self.site['siteID'].dropna().unique()
+
+        # Group the rows of the tables by site/sample once, rather than searching the tables for each site
+        row_groups = {attr: self._data[attr].groupby(column, observed=True, sort=False).indices
+                      for attr, column in [('site', 'siteID'), ('sample', 'siteID'), ('ww_measure', 'sampleID')]}
+
+        return {site_id: SiteData(self, site_id, row_groups) for site_id in site_ids}
+
     @property
     def site(self):
         """Get the site data frame.
@@ -353,8 +523,23 @@ class ODM():
         """
         new = ODM()
         for attr in OdmTables.attributes():
-            new._data[attr] = pd.concat([getattr(first, attr), getattr(second, attr)])
-            new._data[attr].drop_duplicates(subset=new._data[attr].columns[0], keep='first', inplace=True)
+            first_df = getattr(first, attr)
+            second_df = getattr(second, attr)
+            key = first_df.columns[0] if len(first_df.columns) else second_df.columns[0]
+
+            # Only rows from the second table with a new key are added; this
+            # avoids concatenating the full tables just to discard duplicates
+            if key in first_df and key in second_df:
+                second_df = second_df.loc[~second_df[key].isin(first_df[key])]
+
+            # Avoid copying the inputs where possible; duplicate keys within
+            # the first table itself still need to be dropped afterwards
+            new._data[attr] = pd.concat([first_df, second_df], copy=False, ignore_index=True, sort=False)
+            new._data[attr].drop_duplicates(subset=key, keep='first', inplace=True)
+
+            # Categoricals with different categories are concatenated as objects
+            _categorize(attr, new._data[attr])
+
         return new
 
     def __add__(self, other):
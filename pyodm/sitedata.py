@@ -1,7 +1,7 @@
 import pandas as pd
 import numpy as np
 
-from scipy.interpolate import LSQUnivariateSpline
+from scipy.interpolate import splev, splrep
 
 def delta_days(date_2, date_1):
     """Function to return the number of days between two dates"""
@@ -9,15 +9,32 @@ def delta_days(date_2, date_1):
     return delta.days
 
 def spline_model(date, start_date, func):
-    """Function implementing a spline model func(x) with the date represented as a float"""
-    day = delta_days(date, start_date)
-    return func(day)
+    """Function implementing a spline model func(x) with the date (or array of dates) represented as a float"""
+    if np.ndim(date) == 0:
+        date = pd.Timestamp(date).to_datetime64()
+    else:
+        date = pd.to_datetime(date, format="mixed").to_numpy()
+    day = date.astype("datetime64[D]") - np.datetime64(start_date, "D")
+
+    # Missing dates are evaluated as NaN
+    return func(np.where(np.isnat(day), np.nan, day.astype(np.float64)))
+
+def _find_rows(df, column, value, groups=None):
+    """Function to return the positions of the rows of a table with a value in a column, using grouped rows if given"""
+    if groups is not None:
+        return groups.get(value, np.array([], dtype=np.intp))
+    return np.flatnonzero((df[column] == value).to_numpy())
 
 class SiteData():
     """Class used to store and access data for a named sampling site"""
 
-    def __init__(self, data, site_id):
-        """Class initialization"""
+    def __init__(self, data, site_id, row_groups=None):
+        """Class initialization
+
+        The row positions of the "site" and "sample" tables grouped by siteID and of the "ww_measure" table grouped
+        by sampleID can be given in the dict row_groups (keyed by table), to avoid searching the tables for each site.
+        """
+        row_groups = row_groups or {}
 
         # Store reference to the ODM data
         self._data = data
@@ -25,128 +42,182 @@ class SiteData():
         # Store the site_id
         self._site_id = site_id
 
-        # Read relevant information about the site
-        site_data = self._data.site
-        row = site_data.loc[site_data["siteID"] == site_id]
-        self.name = row["name"].values[0]
-        self.description = row["description"].values[0]
-        self.type = row["type"].values[0]
-        self.health_region = row["healthRegion"].values[0]
-        self.health_department = row["publicHealthDepartment"].values[0]
-        self.latitude = row["geoLat"].values[0]
-        self.longitude = row["geoLong"].values[0]
+        # Read relevant information about the site (from the first row for the site)
+        site_rows = _find_rows(self._data.site, "siteID", site_id, row_groups.get("site"))
+        row = self._data.site.iloc[site_rows[0]]
+        self.name = row["name"]
+        self.description = row["description"]
+        self.type = row["type"]
+        self.health_region = row["healthRegion"]
+        self.health_department = row["publicHealthDepartment"]
+        self.latitude = row["geoLat"]
+        self.longitude = row["geoLong"]
 
         # Extract the sample data associated with this site
-        sample_data = self._data.sample
-        self.sample_data = sample_data.loc[sample_data["siteID"] == self._site_id].copy()
+        sample_rows = _find_rows(self._data.sample, "siteID", self._site_id, row_groups.get("sample"))
+        self.sample_data = self._data.sample.take(sample_rows)
 
         # Create a field for "sampleTime" which is either the grab sample time or the end time of a composite
         self.sample_data["sampleTime"] = self.sample_data["dateTimeEnd"].fillna(self.sample_data["dateTime"])
 
-        # Create a field for "sampleDate" which is "sampleTime" without the time
-        self.sample_data["sampleDate"] = pd.to_datetime(self.sample_data["sampleTime"]).dt.date
-
-        # Extract the measurement data associated with this site
-        measure_data = self._data.ww_measure
-        self.measure_data = measure_data.loc[measure_data["sampleID"].isin(self.sample_data["sampleID"])].copy()
+        # Create a field for "sampleDate" which is "sampleTime" without the time (parsing the times only if needed)
+        sample_time = self.sample_data["sampleTime"]
+        if not pd.api.types.is_datetime64_any_dtype(sample_time):
+            sample_time = pd.to_datetime(sample_time)
+        self.sample_data["sampleDate"] = sample_time.dt.floor("D")
+
+        # Store the range of sample dates for this site
+        self.first_sample_date = self.sample_data["sampleDate"].min()
+        self.last_sample_date = self.sample_data["sampleDate"].max()
+
+        # Extract the measurement data associated with this site (keeping the original order of the rows)
+        samples = self.sample_data.drop_duplicates(subset="sampleID")
+        measure_groups = row_groups.get("ww_measure")
+        if measure_groups is not None:
+            measure_rows = [measure_groups[sample_id] for sample_id in samples["sampleID"] if sample_id in measure_groups]
+            measure_rows = np.sort(np.concatenate(measure_rows)) if measure_rows else np.array([], dtype=np.intp)
+        else:
+            measure_rows = np.flatnonzero(self._data.ww_measure["sampleID"].isin(samples["sampleID"]).to_numpy())
+        self.measure_data = self._data.ww_measure.take(measure_rows).reset_index(drop=True)
 
         # Add a column in the measurement data for the sampleDate
-        self.measure_data = self.measure_data.merge(self.sample_data[["sampleID", "sampleDate"]], how="left", on="sampleID")
+        sample_positions = pd.Index(samples["sampleID"]).get_indexer(self.measure_data["sampleID"])
+        self.measure_data["sampleDate"] = samples["sampleDate"].to_numpy()[sample_positions]
 
         # Extract all of the gene names in this file
-        self.genes = self.measure_data["type"].unique()
+        self.genes = np.asarray(self.measure_data["type"].unique())
+
+        # Data by gene keyed by (gene, units, mean)
+        self._gene_data = {}
+
+    def refresh(self):
+        """Discard the cached data by gene (must be called if measure_data is modified)"""
+        self._gene_data.clear()
 
     def get_genes_reported(self):
         """Return the list of all genes reported"""
         return self.genes
 
+    def _get_gene_data(self, gene, units, mean):
+        """Return the (cached) datestamped data for a specific gene, which must not be modified"""
+        key = (gene, units, mean)
+        if key not in self._gene_data:
+            self._gene_data[key] = self._extract_data_by_gene(gene, units, mean)
+        return self._gene_data[key]
+
     def get_data_by_gene(self, gene, units="gcL", mean=True):
         """Return datestamped data for a specific gene"""
-        # Extract the necessary columns
-        measure_data = self.measure_data[["sampleID", "type", "unit", "value", "qualityFlag", "sampleDate"]].copy()
-
-        # Get the rows with the specified gene
-        measure_data = measure_data.loc[self.measure_data["type"] == gene]
-
-        # Drop any blanks
-        measure_data = measure_data.dropna(subset=["value"])
+        # Return a copy so the cached data isn't modified
+        return self._get_gene_data(gene, units, mean).copy()
+
+    def get_arrays_by_gene(self, gene, units="gcL", mean=True):
+        """Return the sample dates and values for a specific gene as a tuple of read-only arrays"""
+        measure_data = self._get_gene_data(gene, units, mean)
+        dates = measure_data["sampleDate"].to_numpy().view()
+        values = measure_data["value"].to_numpy().view()
+        dates.flags.writeable = False
+        values.flags.writeable = False
+        return dates, values
+
+    def _extract_data_by_gene(self, gene, units, mean):
+        """Extract datestamped data for a specific gene from the measurement data"""
+        # Extract the necessary columns of the rows with the specified gene, dropping any blanks
+        rows = (self.measure_data["type"] == gene).to_numpy() & self.measure_data["value"].notna().to_numpy()
+        measure_data = self.measure_data.loc[rows, ["sampleID", "unit", "value", "sampleDate"]]
 
         # Convert units as requires (note: only "gcL" and "gcMl" are supported)
+        unit = measure_data["unit"]
+        value = measure_data["value"].to_numpy()
         if units == "gcL":
-            measure_data.loc[measure_data["unit"] == "gcMl", "value"] = measure_data["value"]*1000.0
+            value = np.where((unit == "gcMl").to_numpy(), value*1000.0, value)
             # Replace zeros with 0.5*LOD (LOD is currently a dummy value)
-            measure_data.loc[measure_data["value"] < 300.0, "value"] = 150.0
+            value = np.where(value < 300.0, 150.0, value)
         elif units == "gcMl":
-            measure_data.loc[measure_data["unit"] == "gcL", "value"] = measure_data["value"]/1000.0
+            value = np.where((unit == "gcL").to_numpy(), value/1000.0, value)
             # Replace zeros with 0.5*LOD (LOD is currently a dummy value)
-            measure_data.loc[measure_data["value"] < 0.3, "value"] = 0.15
+            value = np.where(value < 0.3, 0.15, value)
         else:
             raise ValueError("Invalid units \"{}\" given for wastewater measure.".format(units))
+        measure_data["value"] = value
 
         # Compute the mean if needed
         if mean:
-            measure_data = measure_data.groupby(["sampleID"]).agg({"value" : "mean", "sampleDate" : "first"})
+            grouped = measure_data.groupby("sampleID", observed=True)
+            measure_data = pd.DataFrame({"sampleDate" : grouped["sampleDate"].first(), "value" : grouped["value"].mean()})
 
         # Return the data
         return measure_data[["sampleDate", "value"]]
 
-    def get_normalized_data(self, gene_1, gene_2, units="gcL"):
-        """Return the datestamped data for a specific gene, normalized by another"""
-        # Get the two dataframes
-        data_1 = self.get_data_by_gene(gene_1, units)
-        data_2 = self.get_data_by_gene(gene_2, units)
+    def _get_transformed_arrays(self, gene_1, gene_2, units, standardize=False, log=False):
+        """Return the sample IDs, dates and values of the data for a gene normalized by another, as arrays"""
+        # Get the data for the two genes
+        data_1 = self._get_gene_data(gene_1, units, True)
+        data_2 = self._get_gene_data(gene_2, units, True)
 
-        # Merge the frames and compute normalized signal
-        measure_data = data_1.merge(data_2, how="inner", on="sampleID")
-        measure_data["value"] = measure_data["value_x"]/measure_data["value_y"]
-        measure_data = measure_data.rename(columns={"sampleDate_x" : "sampleDate"}).drop(columns=["sampleDate_y"])
+        # Compute normalized signal for the samples in both frames (which are indexed by sampleID)
+        samples = data_1.index.intersection(data_2.index, sort=False)
+        rows_1 = data_1.index.get_indexer(samples)
+        rows_2 = data_2.index.get_indexer(samples)
+        dates = data_1["sampleDate"].to_numpy()[rows_1]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            value = data_1["value"].to_numpy()[rows_1]/data_2["value"].to_numpy()[rows_2]
 
-        # Return the data
-        return measure_data[["sampleDate", "value"]]
+            # Normalize by standard deviation
+            if standardize:
+                value /= np.std(value)
 
-    def get_standardized_data(self, gene_1, gene_2, units="gcL"):
-        """Return the datestamped data for a normalized conecentration, standardized by its std. dev."""
-        # Get the normalized data
-        measure_data = self.get_normalized_data(gene_1, gene_2, units)
+        # Log transform
+        if log:
+            np.log(value, out=value)
 
-        # Normalize by standard deviation
-        measure_data["value"] = measure_data["value"]/np.std(measure_data["value"])
+        return samples, dates, value
 
-        # Return the data
-        return measure_data[["sampleDate", "value"]]
+    def _get_transformed_data(self, gene_1, gene_2, units, standardize=False, log=False):
+        """Return the datestamped data for a gene normalized by another, optionally standardized and log transformed"""
+        samples, dates, value = self._get_transformed_arrays(gene_1, gene_2, units, standardize, log)
+        return pd.DataFrame({"sampleDate" : dates, "value" : value}, index=samples)
 
-    def get_log_standardized_data(self, gene_1, gene_2, units="gcL"):
-        """Return the datestamped data for standardized concentration, log transformed"""
-        # Get the standardized data
-        measure_data = self.get_standardized_data(gene_1, gene_2, units)
+    def get_normalized_data(self, gene_1, gene_2, units="gcL"):
+        """Return the datestamped data for a specific gene, normalized by another"""
+        return self._get_transformed_data(gene_1, gene_2, units)
 
-        # Log transform
-        measure_data["value"] = np.log(measure_data["value"])
+    def get_standardized_data(self, gene_1, gene_2, units="gcL"):
+        """Return the datestamped data for a normalized conecentration, standardized by its std. dev."""
+        return self._get_transformed_data(gene_1, gene_2, units, standardize=True)
 
-        # Return the data
-        return measure_data[["sampleDate", "value"]]
+    def get_log_standardized_data(self, gene_1, gene_2, units="gcL"):
+        """Return the datestamped data for standardized concentration, log transformed"""
+        return self._get_transformed_data(gene_1, gene_2, units, standardize=True, log=True)
 
-    def get_spline_model(self, gene_1, gene_2, units="gcL"):
-        """Return a spline model of the log standardized date, acceptng a datetime date as an argument"""
+    def get_spline_fit(self, gene_1, gene_2, units="gcL"):
+        """Return the start date and the (t, c, k) tuple of a spline fit of the log standardized data by day"""
         # Get the log transformed standardized data
-        measure_data = self.get_log_standardized_data(gene_1, gene_2, units)
+        _, dates, values = self._get_transformed_arrays(gene_1, gene_2, units, standardize=True, log=True)
 
         # Get the start/end dates of the model
-        start_date = measure_data["sampleDate"].min()
-        end_date = measure_data["sampleDate"].max()
+        start_date = pd.Timestamp(np.nanmin(dates))
+        end_date = pd.Timestamp(np.nanmax(dates))
         duration = delta_days(end_date, start_date)
 
         # Define the knots in the spline
         knots = np.arange(10, duration, 10)
 
-        # Convert the date to a float value
-        measure_data["sampleDate"] = measure_data["sampleDate"].apply(delta_days, args=(start_date,))
+        # Convert the date to a float value (the number of days since the start date)
+        days = ((dates - start_date.to_datetime64())//np.timedelta64(1, "D")).astype(np.float64)
 
         # Sort by date
-        measure_data = measure_data.sort_values(by=["sampleDate"])
+        order = np.argsort(days, kind="stable")
+
+        # Fit the spline model (a least-squares cubic spline with the given interior knots)
+        tck = splrep(days[order], values[order], t=knots, task=-1)
 
+        # Return the start date and the knots, coefficients and degree of the spline
+        return start_date, tck
+
+    def get_spline_model(self, gene_1, gene_2, units="gcL"):
+        """Return a spline model of the log standardized date, acceptng a datetime date or array of dates as an argument"""
         # Fit the spline model
-        spline = LSQUnivariateSpline(measure_data["sampleDate"].to_numpy(), measure_data["value"].to_numpy(), knots)
+        start_date, tck = self.get_spline_fit(gene_1, gene_2, units)
 
         # Return the spline model
-        return lambda x : spline_model(x, start_date, spline)
+        return lambda x : spline_model(x, start_date, lambda day : splev(day, tck))
@@ -0,0 +1,63 @@
+from pyodm import ODM, AggregateModel
+import numpy as np
+import pandas as pd
+import pytest
+from pathlib import Path
+
+@pytest.fixture
+def example_sites():
+    odm = ODM(Path('example/Wastewater_COVID19_2022_02_18/data/'), validate_data=False)
+    return odm.build_all_sites()
+
+@pytest.fixture
+def example_model(example_sites):
+    weights = {site: float(i + 1) for i, site in enumerate(example_sites)}
+    return AggregateModel(example_sites, weights)
+
+def test_date_list_includes_start_and_end(example_model):
+    dates = example_model.get_date_list('2021-01-01', '2022-03-01')
+    assert len(dates) == 425
+    assert dates[0] == np.datetime64('2021-01-01')
+    assert dates[-1] == np.datetime64('2022-03-01')
+
+def test_aggregate_model_dates(example_model, example_sites):
+    aggregate = example_model.get_aggregate_model(list(example_sites), 'covN1', 'nPPMoV', '2021-01-01', '2022-03-01')
+    assert aggregate['sampleDate'].iloc[0] == pd.Timestamp('2021-01-01')
+    assert aggregate['sampleDate'].iloc[-1] == pd.Timestamp('2022-03-01')
+
+def test_aggregate_model_values(example_model, example_sites):
+    sites = list(example_sites)
+    aggregate = example_model.get_aggregate_model(sites, 'covN1', 'nPPMoV', '2021-01-01', '2022-03-01')
+
+    # Evaluate the site models one date at a time, as in the original implementation
+    models = {site: example_sites[site].get_spline_model('covN1', 'nPPMoV') for site in sites}
+    weights = {site: float(i + 1) for i, site in enumerate(sites)}
+    values = []
+    ratios = []
+    for date in pd.date_range('2021-01-01', '2022-03-01'):
+        weighted_sum = 0.0
+        valid_weight = 0.0
+        for site in sites:
+            if example_sites[site].first_sample_date <= date <= example_sites[site].last_sample_date:
+                weighted_sum += weights[site]*float(models[site](date))
+                valid_weight += weights[site]
+        values.append(weighted_sum/valid_weight if valid_weight else np.nan)
+        ratios.append(valid_weight/sum(weights.values()))
+
+    np.testing.assert_allclose(aggregate['value'], values, rtol=1e-9)
+    np.testing.assert_allclose(aggregate['ratio'], ratios, rtol=1e-12)
+
+def test_aggregate_model_matches_previous_values(example_model, example_sites):
+    # Values computed on the example data with the original (date by date) implementation
+    expected = {
+        '2021-01-01': (np.nan, 0.0),
+        '2021-04-15': (-3.1933043705747703, 1.0),
+        '2021-07-01': (-3.742807065546059, 1.0),
+        '2021-10-20': (-4.14955330166777, 1.0),
+        '2022-01-31': (-3.786674803634939, 0.8416666666666667),
+    }
+    aggregate = example_model.get_aggregate_model(list(example_sites), 'covN1', 'nPPMoV', '2021-01-01', '2022-01-31')
+    aggregate = aggregate.set_index('sampleDate')
+    for date, (value, ratio) in expected.items():
+        np.testing.assert_allclose(aggregate.loc[pd.Timestamp(date), 'value'], value, rtol=1e-9)
+        np.testing.assert_allclose(aggregate.loc[pd.Timestamp(date), 'ratio'], ratio, rtol=1e-12)
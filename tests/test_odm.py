@@ -1,4 +1,6 @@
-from pyodm import ODM
+from pyodm import ODM, SiteData
+import io
+import pandas as pd
 import pytest
 from pathlib import Path
 from datetime import datetime
@@ -23,10 +25,62 @@ def test_init_odm_with_excel(excel_file_path):
     odm = ODM(excel_file_path)
     assert True
 
+def test_init_odm_lazily(excel_file_path, monkeypatch):
+    reads = []
+    read_sheet = ODM.read_sheet
+
+    def counting_read_sheet(self, *args):
+        reads.append(args)
+        return read_sheet(self, *args)
+
+    monkeypatch.setattr(ODM, 'read_sheet', counting_read_sheet)
+    odm = ODM(excel_file_path, validate_data=False)
+    assert reads == []
+    odm.sample
+    assert len(reads) == 1
+    expected = ODM(excel_file_path)
+    for attr in ['site', 'reporter', 'lab', 'instrument', 'assay_method', 'sample', 'ww_measure', 'site_measure']:
+        pd.testing.assert_frame_equal(getattr(odm, attr), getattr(expected, attr))
+    assert len(reads) == 2
+
+def test_init_odm_lazily_with_missing_file():
+    with pytest.raises(FileNotFoundError):
+        ODM(Path('missing.xlsx'), validate_data=False)
+
 def test_init_odm_with_csv(csv_dir_path):
     odm = ODM(csv_dir_path)
     assert True
 
+def test_init_odm_without_schema(csv_dir_path, tmp_path):
+    expected = ODM(csv_dir_path, validate_data=False)
+    for schema_file in [None, tmp_path / 'missing.yml']:
+        odm = ODM(csv_dir_path, validate_data=False, validation_schema_file=schema_file)
+        assert len(odm.ww_measure) == len(expected.ww_measure)
+
+@pytest.fixture
+def numeric_id_dir_path(csv_dir_path, tmp_path):
+    # Copy the example data with the sample IDs replaced by numeric-looking ones
+    sample_ids = {}
+    for file_name in ['Sample.csv', 'WWMeasure.csv', 'SiteMeasure.csv']:
+        df = pd.read_csv(csv_dir_path / file_name, dtype=str, keep_default_na=False)
+        if 'sampleID' in df:
+            df['sampleID'] = [sample_ids.setdefault(i, str(1000 + len(sample_ids))) if i != 'NA' else i
+                              for i in df['sampleID']]
+        df.to_csv(tmp_path / file_name, index=False)
+    for file_name in ['Site.csv', 'Reporter.csv', 'Lab.csv', 'Instrument.csv', 'AssayMethod.csv']:
+        (tmp_path / file_name).write_bytes((csv_dir_path / file_name).read_bytes())
+    return tmp_path
+
+def test_numeric_ids_match_across_tables(csv_dir_path, numeric_id_dir_path):
+    expected = ODM(csv_dir_path, validate_data=False)
+    odm = ODM(numeric_id_dir_path, validate_data=False)
+    site_id = odm.site['siteID'].iloc[0]
+    assert len(SiteData(odm, site_id).measure_data) == len(SiteData(expected, site_id).measure_data) > 0
+
+    odm.filter_dates('2021-01-01', '2022-12-31')
+    expected.filter_dates('2021-01-01', '2022-12-31')
+    assert len(odm.ww_measure) == len(expected.ww_measure) > 0
+
 def test_add_odms(example_odm1, example_odm2):
     odm = example_odm1 + example_odm2
     assert True
@@ -50,3 +104,28 @@ def test_filter_start_and_end_date(excel_file_path):
     max_date = datetime.strptime(odm._data['sample']['dateTimeEnd'].max(), '%Y-%m-%d %H:%M:%S').date()
     assert (min_date >= datetime.strptime('2021-1-31', '%Y-%m-%d').date())
     assert (max_date <= datetime.strptime('2021-12-31', '%Y-%m-%d').date())
+
+def test_build_all_sites(csv_dir_path):
+    odm = ODM(csv_dir_path, validate_data=False)
+    sites = odm.build_all_sites()
+    assert list(sites) == list(odm.site['siteID'].unique())
+    for site_id, site in sites.items():
+        expected = SiteData(odm, site_id)
+        assert site.name == expected.name
+        pd.testing.assert_frame_equal(site.sample_data, expected.sample_data)
+        pd.testing.assert_frame_equal(site.measure_data, expected.measure_data)
+
+def test_export_excel_to_buffer(csv_dir_path):
+    odm = ODM(csv_dir_path, validate_data=False)
+    buffer = io.BytesIO()
+    odm.export_excel(buffer)
+    buffer.seek(0)
+    sheets = pd.read_excel(buffer, sheet_name=None)
+    assert len(sheets['1 - Site']) == len(odm.site)
+
+def test_export_excel_xlsm(csv_dir_path, tmp_path):
+    odm = ODM(csv_dir_path, validate_data=False)
+    file_name = str(tmp_path / 'out.xlsm')
+    odm.export_excel(file_name)
+    sheets = pd.read_excel(file_name, sheet_name=None)
+    assert len(sheets['1 - Site']) == len(odm.site)
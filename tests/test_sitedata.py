@@ -0,0 +1,40 @@
+from pyodm import ODM, SiteData
+import numpy as np
+import pandas as pd
+import pytest
+from pathlib import Path
+
+@pytest.fixture
+def example_site():
+    odm = ODM(Path('example/Wastewater_COVID19_2022_02_18/data/'), validate_data=False)
+    return SiteData(odm, 'VLI')
+
+def test_spline_model_array_matches_scalar(example_site):
+    model = example_site.get_spline_model('covN1', 'nPPMoV')
+    dates = pd.date_range('2021-03-01', '2022-02-01')
+    values = model(dates)
+    assert values.shape == (len(dates),)
+    np.testing.assert_allclose(values, [float(model(date)) for date in dates], rtol=1e-12)
+    np.testing.assert_allclose(model(['2021-06-01', '2021/06/02 13:00']), [model('2021-06-01'), model('2021-06-02')])
+
+def test_spline_model_missing_dates(example_site):
+    model = example_site.get_spline_model('covN1', 'nPPMoV')
+    assert np.isnan(model(pd.NaT))
+    values = model(pd.to_datetime(['2021-06-01', None]))
+    assert np.isfinite(values[0]) and np.isnan(values[1])
+
+def test_arrays_by_gene_match_data_by_gene(example_site):
+    for units in ['gcL', 'gcMl']:
+        dates, values = example_site.get_arrays_by_gene('covN1', units)
+        expected = example_site.get_data_by_gene('covN1', units)
+        assert len(values) > 0
+        np.testing.assert_array_equal(dates, expected['sampleDate'].to_numpy())
+        np.testing.assert_array_equal(values, expected['value'].to_numpy())
+
+def test_arrays_by_gene_are_read_only(example_site):
+    dates, values = example_site.get_arrays_by_gene('covN1')
+    with pytest.raises(ValueError):
+        values[0] = 0.0
+    with pytest.raises(ValueError):
+        dates[0] = np.datetime64('2000-01-01')
+    np.testing.assert_array_equal(example_site.get_arrays_by_gene('covN1')[1], example_site.get_data_by_gene('covN1')['value'])